@@ -1,16 +1,29 @@
 # agent.py
 # This is the local agent script that runs on the user's machine.
 # REQUIRED DEPENDENCIES:
-# pip install "python-socketio[client]" watchdog websocket-client
+# pip install "python-socketio[asyncio_client]" watchdog
+# OPTIONAL: pip install orjson; (Linux) pip install inotify_simple
 
-import time
 import os
 import re
+import asyncio
+import mmap
+import queue
 import socketio
+try:
+    import orjson  # Optional: faster Socket.IO packet encoding
+except ImportError:
+    orjson = None
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+try:
+    # Optional, Linux only: lets the agent watch with a narrow inotify mask
+    from inotify_simple import INotify, flags as inotify_flags
+except (ImportError, OSError):
+    INotify = None
 import threading
-from collections import defaultdict
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 # --- GUI Imports ---
 import tkinter as tk
@@ -19,6 +32,18 @@ from tkinter import filedialog, scrolledtext, messagebox
 # --- Configuration ---
 SERVER_URL = "http://127.0.0.1:5000"
 AUTH_TOKEN = "your_super_secret_token_here"
+# Window used to coalesce files created in a burst into a single emit
+CREATE_DEBOUNCE_SECONDS = 0.05
+MAX_BATCH_FILES = 64
+# Files larger than the threshold are sent in chunks instead of one payload
+STREAM_THRESHOLD_BYTES = 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+# Number of (path -> mtime, size) entries remembered to skip unchanged resends
+SENT_CACHE_SIZE = 4096
+# How often buffered log lines are written to the log widget
+LOG_FLUSH_INTERVAL_MS = 100
+# Lines kept in the log widget; older ones are dropped so inserts stay cheap
+LOG_MAX_LINES = 2000
 
 # --- Agent's Internal State ---
 current_filters = {
@@ -28,51 +53,250 @@ current_filters = {
     'range_end': -1,
     'file_extension': '.txt'
 }
+# Immutable snapshot of current_filters used by the matching hot path.
+# It is swapped as a whole, so readers never see a half-applied update.
+FilterSet = namedtuple('FilterSet', 'handle ext start end compiled')
+current_filter_set = None
+sent_files = OrderedDict()
+sent_files_lock = threading.Lock()
 
 # --- Socket.IO Client Setup ---
-sio = socketio.Client(reconnection_attempts=5, reconnection_delay=5)
+class OrJsonSerializer:
+    """json-module stand-in that lets python-socketio encode packets with orjson."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        # orjson always emits compact output, which is what separators= asks for
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+
+# The client runs on its own asyncio loop thread. The scan pool and the file
+# watcher hand emits to that loop, which serializes them onto the socket.
+sio = socketio.AsyncClient(reconnection_attempts=5, reconnection_delay=5,
+                            json=OrJsonSerializer if orjson else None)
+sio_loop = asyncio.new_event_loop()
+threading.Thread(target=sio_loop.run_forever, name="agent-socketio", daemon=True).start()
 agent_logic_thread = None
 observer = None
 
 
 # --- Core Agent Logic ---
 
-def file_matches_filters(filename):
-    """Checks if a file should be sent based on the current filters."""
-    if not filename.endswith(current_filters.get('file_extension', '.txt')):
-        return False
-    if not current_filters.get('handle') or not current_filters.get('frequencies'):
-        return False
-    if not filename.startswith(current_filters['handle']):
-        return False
+def run_on_sio_loop(coro, timeout=None):
+    """Runs a Socket.IO client coroutine on the client loop and waits for its result."""
+    # Waiting keeps every producer's emits in the order it issued them
+    return asyncio.run_coroutine_threadsafe(coro, sio_loop).result(timeout)
+
+
+def _build_filter_set(filters):
+    """
+    Builds the FilterSet snapshot, including one anchored regex that checks
+    handle, allowed frequencies and extension in a single match.
+    Returns None while the filters are incomplete.
+    """
+    handle = filters.get('handle')
+    frequencies = filters.get('frequencies')
+    if not handle or not frequencies:
+        return None
+    ext = filters.get('file_extension', '.txt')
+    freq_alternation = '|'.join(str(int(f)) for f in frequencies)
+    compiled = re.compile(rf'^{re.escape(handle)}.*?_0*({freq_alternation})(?i:Hz)_?_?(\d+)(?=\.).*{re.escape(ext)}$')
+    return FilterSet(handle, ext, filters['range_start'], filters['range_end'], compiled)
+
+
+def _fast_file_number(filename):
+    """
+    Extracts <num> from names shaped like '..Hz_<num>.<ext>' with plain string
+    scans. Returns None for any other shape so the caller uses the regex.
+    """
+    dot = filename.rfind('.')
+    sep = filename.rfind('_', 0, dot) if dot > 0 else -1
+    if sep < 0:
+        return None
+    head = filename[:sep].lower()
+    if not (head.endswith('hz') or head.endswith('hz_')):
+        return None
+    try:
+        return int(filename[sep + 1:dot])
+    except ValueError:
+        return None
+
+
+def _parse_and_match(filename, fs):
+    """
+    Runs the prebuilt filter regex of the FilterSet `fs` once and checks the
+    file number range. Returns (freq, num) if the file should be sent, otherwise None.
+    """
+    if fs is None:
+        return None
+    if not filename.endswith(fs.ext):
+        return None
+    if not filename.startswith(fs.handle):
+        return None
+    # Out-of-range numbers are the common rejection; settle them without the regex engine
+    num = _fast_file_number(filename)
+    if num is not None and not (fs.start <= num <= fs.end):
+        return None
+    match = fs.compiled.match(filename)
+    if not match:
+        return None
+    num = int(match.group(2))
+    if not (fs.start <= num <= fs.end):
+        return None
+    return int(match.group(1)), num
+
+
+# O_BINARY only exists on Windows, where it disables newline translation
+_READ_FLAGS = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+
+
+def read_file_content(file_path):
+    # Raw bytes go out as binary Socket.IO attachments, skipping JSON string escaping.
+    # A plain os.read of the known size avoids the buffered file object layers.
+    fd = os.open(file_path, _READ_FLAGS)
+    try:
+        return os.read(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+
+def _is_large_file(file_path):
     try:
-        match = re.search(r'_(\d+)Hz_?_?(\d+)\.', filename, re.IGNORECASE)
-        if not match: return False
-        freq, num = int(match.group(1)), int(match.group(2))
-    except (ValueError, IndexError):
-        return False
-    if freq not in current_filters['frequencies']:
-        return False
-    if not (current_filters['range_start'] <= num <= current_filters['range_end']):
-        return False
-    # No log here to prevent clutter, logging is done when sending
-    return True
+        return os.path.getsize(file_path) > STREAM_THRESHOLD_BYTES
+    except OSError:
+        return False  # Let the read path report the error
+
+
+def stream_file_to_server(file_path):
+    """
+    Sends a large file as fixed-size binary chunks read through mmap, so the
+    agent never holds more than one chunk of it in a Python object.
+    The server reassembles the chunks by (filename, seq).
+    """
+    filename = os.path.basename(file_path)
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        app.log(f"--> Streaming '{filename}' ({size} bytes)...")
+        for seq, offset in enumerate(range(0, size, STREAM_CHUNK_SIZE)):
+            end = offset + STREAM_CHUNK_SIZE
+            run_on_sio_loop(sio.emit('stream_instrument_chunk',
+                                     {'filename': filename, 'seq': seq, 'data': mm[offset:end], 'final': end >= size}))
 
 
 def send_file_to_server(file_path):
     """Reads a file and sends its content to the server via WebSocket."""
     try:
-        time.sleep(0.1)  # Reduced sleep time for faster batch processing
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
         filename = os.path.basename(file_path)
-        if sio.connected:
-            app.log(f"--> Sending '{filename}'...")
-            sio.emit('stream_instrument_data', {'filename': filename, 'content': content})
-        else:
+        if not sio.connected:
             app.log(f"[Warning] Cannot send '{filename}', not connected.")
+            return False
+        if _is_large_file(file_path):
+            stream_file_to_server(file_path)
+            return True
+        content = read_file_content(file_path)
+        app.log(f"--> Sending '{filename}'...")
+        run_on_sio_loop(sio.emit('stream_instrument_data', {'filename': filename, 'content': content}))
+        return True
     except Exception as e:
         app.log(f"[Error] Could not read or send file {file_path}: {e}")
+    return False
+
+
+def _read_batch_item(file_path):
+    try:
+        return {'filename': os.path.basename(file_path), 'content': read_file_content(file_path)}
+    except Exception as e:
+        app.log(f"[Error] Could not read file {file_path}: {e}")
+        return None
+
+
+def _file_signature(file_path):
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None  # Let the read path report the error
+    return st.st_mtime_ns, st.st_size
+
+
+def _reserve_send(file_path, signature):
+    """
+    Claims file_path for sending unless it was already sent (or is being sent)
+    with the same signature. Check and insert happen under one lock, so the scan
+    and the event consumer cannot both send a file they see at the same moment.
+    """
+    with sent_files_lock:
+        if sent_files.get(file_path) == signature:
+            return False
+        sent_files[file_path] = signature
+        sent_files.move_to_end(file_path)
+        while len(sent_files) > SENT_CACHE_SIZE:
+            sent_files.popitem(last=False)
+        return True
+
+
+def _release_send(file_path, signature):
+    # Drops a reservation whose send failed, so the file is tried again later
+    if signature is None:
+        return
+    with sent_files_lock:
+        if sent_files.get(file_path) == signature:
+            del sent_files[file_path]
+
+
+def send_files_to_server(file_paths):
+    """
+    Reads several files on the worker pool and sends them in one
+    'stream_instrument_data_batch' emit. A single file uses the plain event
+    and files above STREAM_THRESHOLD_BYTES are streamed on their own.
+    Files already sent with the same mtime and size are skipped.
+    """
+    signatures = {}
+    for file_path in file_paths:
+        signature = _file_signature(file_path)
+        if signature is None or _reserve_send(file_path, signature):
+            signatures[file_path] = signature
+    skipped = len(file_paths) - len(signatures)
+    if skipped:
+        app.log(f"Skipping {skipped} unchanged file(s) that were already sent.")
+
+    file_paths = []
+    for file_path, signature in signatures.items():
+        if signature and signature[1] > STREAM_THRESHOLD_BYTES:
+            if not send_file_to_server(file_path):
+                _release_send(file_path, signature)
+        else:
+            file_paths.append(file_path)
+    if not file_paths:
+        return
+    if len(file_paths) == 1:
+        if not send_file_to_server(file_paths[0]):
+            _release_send(file_paths[0], signatures[file_paths[0]])
+        return
+    read_items = list(zip(file_paths, app.send_pool.map(_read_batch_item, file_paths)))
+    for file_path, item in read_items:
+        if not item:
+            _release_send(file_path, signatures[file_path])
+    items = [item for _, item in read_items if item]
+    if not items:
+        return
+    sent = False
+    try:
+        if sio.connected:
+            app.log(f"--> Sending {len(items)} files: {', '.join(item['filename'] for item in items)}")
+            run_on_sio_loop(sio.emit('stream_instrument_data_batch', {'items': items}))
+            sent = True
+        else:
+            app.log(f"[Warning] Cannot send {len(items)} files, not connected.")
+    except Exception as e:
+        app.log(f"[Error] Could not send file batch: {e}")
+    if not sent:
+        for file_path, item in read_items:
+            if item:
+                _release_send(file_path, signatures[file_path])
 
 
 def process_existing_files_with_filters(directory):
@@ -80,28 +304,29 @@ def process_existing_files_with_filters(directory):
     [FIXED] Scans, groups, and sends files in the correct, interleaved order.
     """
     app.log("\n--- Scanning for existing files with current filters... ---")
+    fs = current_filter_set
     try:
-        all_files = os.listdir(directory)
-
-        # Group files by their number
-        files_by_number = defaultdict(list)
-        for filename in all_files:
-            if os.path.isfile(os.path.join(directory, filename)) and file_matches_filters(filename):
-                match = re.search(r'_(\d+)Hz_?_?(\d+)\.', filename, re.IGNORECASE)
-                if match:
-                    file_num = int(match.group(2))
-                    files_by_number[file_num].append(filename)
-
-        # Process in numerical order
-        sorted_file_numbers = sorted(files_by_number.keys())
-        app.log(f"Found {len(sorted_file_numbers)} file number groups to process.")
-
-        for num in sorted_file_numbers:
+        # Every matched number lies inside the filter range, so one slot per number,
+        # indexed by num - range_start, keeps the groups in order without sorting.
+        buckets = [None] * (fs.end - fs.start + 1) if fs is not None else []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                parsed = _parse_and_match(entry.name, fs)
+                if parsed and entry.is_file():
+                    idx = parsed[1] - fs.start
+                    if buckets[idx] is None:
+                        buckets[idx] = [entry.path]
+                    else:
+                        buckets[idx].append(entry.path)
+
+        groups = [group for group in buckets if group]
+        app.log(f"Found {len(groups)} file number groups to process.")
+
+        for group in groups:
             # Sort files within the group by frequency to be consistent
-            files_by_number[num].sort()
-            for filename in files_by_number[num]:
-                full_path = os.path.join(directory, filename)
-                send_file_to_server(full_path)
+            group.sort()
+            # One emit per number group keeps the interleaved order across numbers
+            send_files_to_server(group)
 
     except Exception as e:
         app.log(f"[Error] Failed during initial scan: {e}")
@@ -111,29 +336,35 @@ def process_existing_files_with_filters(directory):
 
 # --- Socket.IO Event Handlers ---
 @sio.event
-def connect():
+async def connect():
     app.update_status("Connected", "green")
     app.log(f"Successfully connected to server: {SERVER_URL}")
 
 
 @sio.event
-def connect_error(data):
+async def connect_error(data):
     app.update_status("Connection Failed", "red")
     app.log(f"Connection failed! Please check if the server is running at {SERVER_URL}.")
 
 
 @sio.event
-def disconnect():
+async def disconnect():
     app.update_status("Disconnected", "red")
     app.log("Disconnected from server.")
 
 
 @sio.on('set_filters')
-def on_set_filters(data):
+async def on_set_filters(data):
     """Called when the SERVER sends new filter instructions."""
-    global current_filters
+    global current_filter_set
     app.log(f"<-- Received new filter instructions from server: {data}")
+    # Only this handler writes the filters and it runs on the client loop without awaiting,
+    # so updates never overlap; readers only use the snapshot swapped in below
     current_filters.update(data)
+    current_filter_set = _build_filter_set(current_filters)
+    # The server resets its trend data for every new session, so it needs every file again
+    with sent_files_lock:
+        sent_files.clear()
     # Use a thread to avoid blocking the UI while scanning
     scan_thread = threading.Thread(target=process_existing_files_with_filters, args=(app.watch_directory.get(),),
                                    daemon=True)
@@ -142,24 +373,98 @@ def on_set_filters(data):
 
 # --- Real-time File System Event Handler ---
 class InstrumentDataHandler(FileSystemEventHandler):
+    """
+    Hands created paths to a queue so the watchdog thread returns immediately.
+    A consumer thread groups events arriving within CREATE_DEBOUNCE_SECONDS of
+    each other and sends the matching files in one batch.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._event_q = queue.Queue()
+        threading.Thread(target=self._drain_events, daemon=True).start()
+
     def on_created(self, event):
-        if not event.is_directory:
-            filename = os.path.basename(event.src_path)
-            app.log(f"New file detected: '{filename}'")
-            if file_matches_filters(filename):
-                send_file_to_server(event.src_path)
+        # Until the server sends filters nothing can match, and the scan that runs
+        # on set_filters picks up anything created in the meantime.
+        if not event.is_directory and current_filter_set is not None:
+            self.enqueue(event.src_path)
+
+    def enqueue(self, file_path):
+        self._event_q.put(file_path)
+
+    def _drain_events(self):
+        while True:
+            batch = [self._event_q.get()]
+            while len(batch) < MAX_BATCH_FILES:
+                try:
+                    batch.append(self._event_q.get(timeout=CREATE_DEBOUNCE_SECONDS))
+                except queue.Empty:
+                    break
+            matching = []
+            for file_path in batch:
+                filename = os.path.basename(file_path)
+                app.log(f"New file detected: '{filename}'")
+                if _parse_and_match(filename, current_filter_set):
+                    matching.append(file_path)
+            if matching:
+                send_files_to_server(matching)
+
+
+class InotifyObserver(threading.Thread):
+    """
+    Linux-only replacement for watchdog's Observer with the same
+    schedule/start/stop/join interface. The watch mask only covers
+    IN_CREATE and IN_MOVED_TO, and names are checked against the handle and
+    extension before anything is queued, so unrelated writes in the folder
+    never reach Python-level handlers.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self._inotify = INotify()
+        self._stopped = threading.Event()
+        self._handler = None
+        self._directory = None
+
+    def schedule(self, event_handler, directory, recursive=False):
+        self._handler = event_handler
+        self._directory = directory
+        self._inotify.add_watch(directory, inotify_flags.CREATE | inotify_flags.MOVED_TO)
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                # One read returns every event queued since the last one
+                for event in self._inotify.read(timeout=200):
+                    if event.mask & inotify_flags.ISDIR:
+                        continue
+                    fs = current_filter_set
+                    if fs is None or not (event.name.startswith(fs.handle) and event.name.endswith(fs.ext)):
+                        continue
+                    self._handler.enqueue(os.path.join(self._directory, event.name))
+        finally:
+            self._inotify.close()
+
+    def stop(self):
+        self._stopped.set()
 
 
 # --- GUI Application Class ---
 class AgentApp:
+    __slots__ = ('root', 'watch_directory', 'send_pool', 'folder_display', 'select_button', 'start_button',
+                 'status_display', 'log_text', '_log_buffer', '_closing')
+
     def __init__(self, root):
         self.root = root
+        self._closing = False
         self.root.title("SACMES Local Agent")
         self.root.geometry("600x450")
         self.root.minsize(500, 350)
 
         self.watch_directory = tk.StringVar()
         self.watch_directory.set("No folder selected")
+        self.send_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="agent-send")
 
         main_frame = tk.Frame(root, padx=10, pady=10)
         main_frame.pack(fill=tk.BOTH, expand=True)
@@ -199,6 +504,9 @@ class AgentApp:
         self.log_text = scrolledtext.ScrolledText(log_frame, state='disabled', wrap=tk.WORD, font=("Courier New", 9))
         self.log_text.pack(fill=tk.BOTH, expand=True, pady=(5, 0))
 
+        self._log_buffer = deque(maxlen=5000)
+        self.root.after(LOG_FLUSH_INTERVAL_MS, self._flush_log)
+
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
     def select_folder(self):
@@ -228,10 +536,10 @@ class AgentApp:
             self.log(f"Attempting to connect to server at {SERVER_URL}...")
 
             headers = {"Authorization": f"Bearer {AUTH_TOKEN}"}
-            sio.connect(SERVER_URL, headers=headers, socketio_path='socket.io')
+            run_on_sio_loop(sio.connect(SERVER_URL, headers=headers, socketio_path='socket.io'))
 
             event_handler = InstrumentDataHandler()
-            observer = Observer()
+            observer = InotifyObserver() if INotify is not None else Observer()
             observer.schedule(event_handler, self.watch_directory.get(), recursive=False)
             observer.start()
 
@@ -246,15 +554,28 @@ class AgentApp:
             self.update_status("Error", "red")
 
     def log(self, message):
-        self.root.after(0, self._log_message, message)
-
-    def _log_message(self, message):
-        self.log_text.config(state='normal')
-        self.log_text.insert(tk.END, f"{message}\n")
-        self.log_text.config(state='disabled')
-        self.log_text.see(tk.END)
+        # Called from any thread; deque appends are atomic and _flush_log drains them
+        self._log_buffer.append(message)
+
+    def _flush_log(self):
+        if self._log_buffer:
+            lines = []
+            while self._log_buffer:
+                lines.append(self._log_buffer.popleft())
+            self.log_text.config(state='normal')
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            # 'end-1c' is on the empty line after the last newline, so this counts it too
+            excess = int(self.log_text.index('end-1c').split('.')[0]) - 1 - LOG_MAX_LINES
+            if excess > 0:
+                self.log_text.delete('1.0', f'{excess + 1}.0')
+            self.log_text.config(state='disabled')
+            self.log_text.see(tk.END)
+        self.root.after(LOG_FLUSH_INTERVAL_MS, self._flush_log)
 
     def update_status(self, text, color):
+        # Socket handlers still fire while the window is being torn down; leave Tk alone then
+        if self._closing:
+            return
         self.root.after(0, self._update_status, text, color)
 
     def _update_status(self, text, color):
@@ -263,11 +584,14 @@ class AgentApp:
     def on_closing(self):
         if messagebox.askokcancel("Exit", "Are you sure you want to close the agent?"):
             global observer
+            self._closing = True
             if observer and observer.is_alive():
                 observer.stop()
                 observer.join()
+            self.send_pool.shutdown(wait=False, cancel_futures=True)
             if sio.connected:
-                sio.disconnect()
+                # Fire and forget: waiting here would block the Tk thread on the socket loop
+                asyncio.run_coroutine_threadsafe(sio.disconnect(), sio_loop)
             self.root.destroy()
 
 
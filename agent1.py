@@ -1,13 +1,32 @@
-# agent1.py (Final Version - Forcing HTTP Long-Polling)
-# This version forces the connection to use HTTP long-polling instead of WebSockets,
-# making it much more robust against aggressive network proxies in cloud environments.
+# agent1.py (Final Version - HTTP Long-Polling First)
+# This version opens the connection with HTTP long-polling, which gets through aggressive
+# network proxies in cloud environments, and only then tries to upgrade to a WebSocket
+# (unless FORCE_POLLING=1 is set in the environment).
+# REQUIRED: pip install "python-socketio[asyncio_client]"
+# OPTIONAL DEPENDENCIES: pip install watchfiles  (event-driven folder monitoring instead of polling)
+#                        pip install orjson      (faster Socket.IO packet encoding)
 
 import os
 import re
+import asyncio
+import functools
+import mmap
 import time
 import socketio
+try:
+    import orjson  # Optional: faster Socket.IO packet encoding
+except ImportError:
+    orjson = None
+import heapq
 import threading
-from collections import defaultdict
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+try:
+    # OS-level change notifications (inotify / FSEvents / ReadDirectoryChangesW)
+    from watchfiles import watch, Change
+except ImportError:
+    watch = None
 
 # --- GUI (using Python's built-in library) ---
 import tkinter as tk
@@ -17,132 +36,422 @@ from tkinter import filedialog, scrolledtext, messagebox
 SERVER_URL = "https://sacmes-web-narroyo.apps.cloudapps.unc.edu"
 AUTH_TOKEN = "your_super_secret_token_here"
 POLLING_INTERVAL_SECONDS = 2
+# Force the listdir polling monitor, e.g. for network drives (NFS/SMB) where OS file
+# events are unreliable. Polling is also used automatically when watchfiles is missing.
+USE_POLLING = False
+# How far a directory mtime must predate the last scan before the poller skips an
+# unchanged directory (covers coarse timestamps, e.g. FAT's 2 s)
+MTIME_SETTLE_NS = 2_000_000_000
 SEND_DELAY_SECONDS = 0.05  # Keep this delay to be gentle on the server
+BATCH_SIZE = 16  # Files per emit; 1 sends every file on its own
+# Instrument data suffixes accepted when the server sends no file extension
+_ALLOWED_EXT = ('.txt', '.dta', '.csv')
+LOG_FLUSH_INTERVAL_MS = 100  # How often buffered log lines are written to the log widget
+LOG_MAX_LINES = 2000  # Lines kept in the log widget; older ones are dropped so inserts stay cheap
+COMPRESSION_LEVEL = 3  # zlib level for file bodies; numeric text shrinks several-fold even at low levels
+COMPRESS_MIN_BYTES = 8 * 1024  # Smaller files are sent as-is; deflate barely pays off for them
+# Files of at least STREAM_THRESHOLD_BYTES are deflated from a memory map and sent
+# as STREAM_CHUNK_SIZE chunks instead of being held whole in memory
+STREAM_THRESHOLD_BYTES = 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+# Set FORCE_POLLING=1 to stay on HTTP long-polling for proxies that accept the
+# WebSocket upgrade but then stall or buffer its frames
+SIO_TRANSPORTS = ['polling'] if os.environ.get('FORCE_POLLING') == '1' else ['polling', 'websocket']
+# Per-packet Socket.IO/Engine.IO debug logging; set SACMES_SIO_DEBUG=1 to turn it on
+SIO_DEBUG = os.environ.get('SACMES_SIO_DEBUG') == '1'
 
 # --- Agent's Internal State ---
 current_filters = {}
+# Immutable snapshot derived from current_filters in on_set_filters: the handle and
+# extensions for quick rejects, the frequency set and number range, a length floor,
+# and one regex anchored at the handle, so candidates need a single match() call.
+# It is swapped in one assignment, so the monitor never sees half-updated filters.
+REQUIRED_FILTER_KEYS = ('handle', 'frequencies', 'range_start', 'range_end')
+FilterSnapshot = namedtuple('FilterSnapshot', 'handle ext frequencies start end min_len regex')
+_filter_snapshot = None
+# Names sent this session; it only grows as the directory does, and is reset with the filters
 processed_files = set()
-is_monitoring_active = False
+monitor_stop_event = threading.Event()
 agent_thread = None
+# The client starts each incoming packet as its own task, so two set_filters packets
+# can overlap; this keeps their monitor restarts from interleaving
+filters_apply_lock = threading.Lock()
+reader_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='agent-reader')
 
 # --- Socket.IO Client Setup ---
-# The KEY CHANGE is forcing transports=['polling']
-sio = socketio.Client(reconnection_attempts=5, reconnection_delay=5, logger=True, engineio_logger=True)
+class OrJsonSerializer:
+    """json-module stand-in that lets python-socketio encode packets with orjson."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        # orjson always emits compact output, which is what separators= asks for
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+
+# The KEY CHANGE is connecting with transports=SIO_TRANSPORTS
+# The client runs on its own asyncio loop thread; the monitor thread hands its
+# emits to that loop instead of sharing the client's threads with Tk.
+sio = socketio.AsyncClient(reconnection_attempts=5, reconnection_delay=5, logger=SIO_DEBUG, engineio_logger=SIO_DEBUG,
+                           json=OrJsonSerializer if orjson else None)
+sio_loop = asyncio.new_event_loop()
+threading.Thread(target=sio_loop.run_forever, name="agent-socketio", daemon=True).start()
 
 
 # --- Core Agent Logic (Unchanged)---
 
-def file_matches_filters(filename):
-    """Checks if a file matches the current filter rules received from the server."""
-    required_keys = ['handle', 'frequencies', 'range_start', 'range_end', 'file_extension']
-    if not all(k in current_filters for k in required_keys):
-        return False
-    if not filename.endswith(current_filters['file_extension']):
-        return False
-    if not filename.startswith(current_filters['handle']):
-        return False
+def run_on_sio_loop(coro, timeout=None):
+    """Runs a Socket.IO client coroutine on the client loop and waits for its result."""
+    # Waiting keeps the monitor's emits in the order it issued them
+    return asyncio.run_coroutine_threadsafe(coro, sio_loop).result(timeout)
+
+
+@functools.lru_cache(maxsize=128)
+def handle_pattern(handle):
+    """Compiled filename regex for `handle`; kept across sessions that reuse a handle."""
+    return re.compile(rf'{re.escape(handle)}.*?_(\d+)(?i:Hz)_?_?(\d+)\.')
+
+
+def matching_file_number(filename):
+    """
+    Checks if a file matches the current filter rules received from the server
+    and returns its file number, or None if it does not match.
+    """
+    fs = _filter_snapshot
+    if fs is None:
+        return None
+    if len(filename) < fs.min_len:
+        return None
+    if not filename.endswith(fs.ext):
+        return None
+    if not filename.startswith(fs.handle):
+        return None
     try:
-        match = re.search(r'_(\d+)Hz_?_?(\d+)\.', filename, re.IGNORECASE)
-        if not match: return False
+        match = fs.regex.match(filename)
+        if not match: return None
         freq, num = int(match.group(1)), int(match.group(2))
     except (ValueError, IndexError):
-        return False
-    if freq not in current_filters['frequencies']:
-        return False
-    if not (current_filters['range_start'] <= num <= current_filters['range_end']):
-        return False
-    return True
+        return None
+    if freq not in fs.frequencies:
+        return None
+    if not (fs.start <= num <= fs.end):
+        return None
+    return num
+
+
+def build_filter_snapshot(filters):
+    """Builds the FilterSnapshot for `filters`, or None while they are incomplete."""
+    if not all(k in filters for k in REQUIRED_FILTER_KEYS):
+        return None
+    handle = filters['handle']
+    # Always a tuple, so matching_file_number does a single endswith() over all suffixes
+    file_extension = filters.get('file_extension')
+    ext = (file_extension,) if file_extension else _ALLOWED_EXT
+    # Shortest possible name: <handle>_<d>Hz<d><ext>
+    min_len = len(handle) + len('_0Hz0') + min(map(len, ext))
+    return FilterSnapshot(handle, ext, frozenset(filters['frequencies']), filters['range_start'],
+                          filters['range_end'], min_len, handle_pattern(handle))
+
+
+def read_files(directory, filenames):
+    """
+    Reads files for one emit. Unreadable files are logged and left out; large
+    files only get their path recorded and are streamed when their turn comes.
+    """
+    items = []
+    # Joined once; the per-file path is then a plain concatenation
+    prefix = os.path.join(directory, '')
+    for filename in filenames:
+        try:
+            # Raw bytes travel as a binary attachment, deflated when large enough; the
+            # server inflates them and writes them out verbatim
+            with open(prefix + filename, 'rb') as f:
+                if os.fstat(f.fileno()).st_size >= STREAM_THRESHOLD_BYTES:
+                    items.append({'filename': filename, 'path': prefix + filename})
+                    continue
+                content = f.read()
+            if len(content) > COMPRESS_MIN_BYTES:
+                items.append({'filename': filename, 'content_z': zlib.compress(content, COMPRESSION_LEVEL),
+                              'encoding': 'deflate'})
+            else:
+                items.append({'filename': filename, 'content': content})
+        except Exception as e:
+            app.log(f"[Error] Could not read file {filename}: {e}")
+    return items
 
 
-def send_file_to_server(file_path):
-    """Reads a file's content and sends it to the server via WebSocket."""
+def stream_file_to_server(file_path, filename):
+    """
+    Sends a large file as deflated 'stream_instrument_chunk' frames, compressing
+    it chunk by chunk from a memory map so only one chunk is held at a time.
+    The server reassembles the chunks by (filename, seq) and inflates the result.
+    """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        app.log(f"--> Streaming '{filename}' ({size} bytes)...")
+        seq = 0
+        for offset in range(0, size, STREAM_CHUNK_SIZE):
+            data = compressor.compress(mm[offset:offset + STREAM_CHUNK_SIZE])
+            if data:
+                run_on_sio_loop(sio.emit('stream_instrument_chunk', {'filename': filename, 'seq': seq, 'data': data,
+                                                                     'encoding': 'deflate', 'final': False}))
+                seq += 1
+    run_on_sio_loop(sio.emit('stream_instrument_chunk', {'filename': filename, 'seq': seq, 'data': compressor.flush(),
+                                                         'encoding': 'deflate', 'final': True}))
+
+
+def _emit_items(items):
+    if len(items) == 1:
+        app.log(f"--> Sending '{items[0]['filename']}'...")
+        run_on_sio_loop(sio.emit('stream_instrument_data', items[0]))
+    elif items:
+        app.log(f"--> Sending {len(items)} files: {', '.join(item['filename'] for item in items)}")
+        run_on_sio_loop(sio.emit('stream_instrument_data_batch', {'items': items}))
+
+
+def _send_pending(items):
     try:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-        filename = os.path.basename(file_path)
-        if sio.connected:
-            app.log(f"--> Sending '{filename}'...")
-            sio.emit('stream_instrument_data', {'filename': filename, 'content': content})
-        else:
-            app.log(f"[Warning] Cannot send '{filename}', not connected.")
-            global is_monitoring_active
-            is_monitoring_active = False
+        _emit_items(items)
     except Exception as e:
-        app.log(f"[Error] Could not read or send file {file_path}: {e}")
+        app.log(f"[Error] Could not send file(s): {e}")
+        return []
+    return [item['filename'] for item in items]
 
 
-def monitor_directory_loop(directory):
+def send_files_to_server(items):
     """
-    Continuously polls the target directory, finds new matching files,
-    and processes them in the correct order with a delay.
+    Sends the items from read_files to the server in order: a single file as
+    'stream_instrument_data', several in one 'stream_instrument_data_batch' emit,
+    and large files as a chunk stream between them.
+    Returns the names of the files that were sent; a failed emit or stream only
+    drops its own files, which stay unprocessed so the monitor loops retry them.
+    """
+    if not items:
+        return []
+    if not sio.connected:
+        app.log(f"[Warning] Cannot send {len(items)} file(s), not connected.")
+        monitor_stop_event.set()
+        return []
+    sent = []
+    pending = []
+    for item in items:
+        if 'path' in item:
+            sent.extend(_send_pending(pending))
+            pending = []
+            try:
+                stream_file_to_server(item['path'], item['filename'])
+                sent.append(item['filename'])
+            except Exception as e:
+                app.log(f"[Error] Could not stream file {item['filename']}: {e}")
+        else:
+            pending.append(item)
+    sent.extend(_send_pending(pending))
+    return sent
+
+
+def _pop_batch(pending_heap):
+    """Pops up to BATCH_SIZE file names off the heap, lowest (number, name) first."""
+    return [heapq.heappop(pending_heap)[1] for _ in range(min(BATCH_SIZE, len(pending_heap)))]
+
+
+def process_new_files(directory, filenames):
+    """
+    Sends every not-yet-processed matching file among `filenames` in the
+    correct order, BATCH_SIZE files per emit with a delay between emits.
+    The next batch is read on the reader pool while the current one is sent.
+    Returns the matching names that could not be read or sent, for the caller
+    to retry, or None if monitoring was stopped meanwhile.
+    """
+    # Single pass: filter and dedupe onto a heap keyed by (file number, name); most
+    # polls bring only a handful of files, so no full sort is needed
+    pending_heap = []
+    for filename in filenames:
+        if filename in processed_files:
+            continue
+        num = matching_file_number(filename)
+        if num is not None:
+            heapq.heappush(pending_heap, (num, filename))
+    if not pending_heap:
+        return []
+    unsent = []
+    app.log(f"Found {len(pending_heap)} new file(s) to process...")
+    batch = _pop_batch(pending_heap)
+    # Only one batch is read ahead, which bounds the memory held by prefetched files
+    pending_read = reader_pool.submit(read_files, directory, batch)
+    while batch:
+        if monitor_stop_event.is_set():
+            pending_read.cancel()
+            app.log("Monitoring stopped, aborting file sending.")
+            return None
+        items = pending_read.result()
+        next_batch = _pop_batch(pending_heap)
+        if next_batch:
+            pending_read = reader_pool.submit(read_files, directory, next_batch)
+        # Only what actually went out is marked; unread or unsent files are handed back
+        sent = set(send_files_to_server(items))
+        processed_files.update(sent)
+        unsent.extend(name for name in batch if name not in sent)
+        batch = next_batch
+        monitor_stop_event.wait(SEND_DELAY_SECONDS)
+    return unsent
+
+
+def poll_directory_loop(directory):
+    """
+    Fallback monitor: checks the directory every POLLING_INTERVAL_SECONDS and
+    scans it when its mtime says entries may have been added.
+    Names are only evaluated on the first scan that lists them; the filters are
+    fixed for the lifetime of this loop, so a name's verdict never changes.
+    Only the latest listing is remembered, so memory follows the directory's
+    current size rather than every name it has ever held. Files that could not
+    be read or sent are retried on every poll while they are still listed.
     """
-    global processed_files
-    app.log(f"--- Started monitoring folder: '{directory}' ---")
     app.log(f"--- Polling interval: {POLLING_INTERVAL_SECONDS} seconds ---")
-    while is_monitoring_active:
+    seen_names = set()
+    retry_names = set()
+    last_mtime_ns = None
+    last_scan_ns = 0
+    while not monitor_stop_event.is_set():
         try:
-            new_matching_files = [f for f in os.listdir(directory) if file_matches_filters(f) and f not in processed_files]
-            if new_matching_files:
-                files_by_number = defaultdict(list)
-                for filename in new_matching_files:
-                    match = re.search(r'_(\d+)Hz_?_?(\d+)\.', filename, re.IGNORECASE)
-                    if match:
-                        files_by_number[int(match.group(2))].append(filename)
-                app.log(f"Found {len(new_matching_files)} new file(s) to process...")
-                for num in sorted(files_by_number.keys()):
-                    for filename in sorted(files_by_number[num]):
-                        if not is_monitoring_active:
-                            app.log("Monitoring stopped, aborting file sending.")
-                            return
-                        send_file_to_server(os.path.join(directory, filename))
-                        processed_files.add(filename)
-                        time.sleep(SEND_DELAY_SECONDS)
-            time.sleep(POLLING_INTERVAL_SECONDS)
+            # Adding a file bumps the directory's mtime, so an unchanged mtime means no
+            # new names. It is only trusted once it is clearly older than the last scan;
+            # a file created in the same timestamp tick as that scan would not bump it.
+            mtime_ns = os.stat(directory).st_mtime_ns
+            new_names = set()
+            if mtime_ns != last_mtime_ns or mtime_ns > last_scan_ns - MTIME_SETTLE_NS:
+                last_mtime_ns, last_scan_ns = mtime_ns, time.time_ns()
+                with os.scandir(directory) as entries:
+                    names = {entry.name for entry in entries if entry.is_file()}
+                new_names = names - seen_names
+                seen_names = names
+                # Removing a file bumps the mtime too, so this drops retries for deleted files
+                retry_names &= names
+            if new_names or retry_names:
+                unsent = process_new_files(directory, new_names | retry_names)
+                if unsent is None:
+                    return
+                retry_names = set(unsent)
+            monitor_stop_event.wait(POLLING_INTERVAL_SECONDS)
         except FileNotFoundError:
             app.log(f"[FATAL] Monitored directory '{directory}' no longer exists. Stopping.")
             app.stop_monitoring_logic()
             break
         except Exception as e:
             app.log(f"[Error] An unexpected error occurred in the monitoring loop: {e}")
-            time.sleep(POLLING_INTERVAL_SECONDS * 2)
+            monitor_stop_event.wait(POLLING_INTERVAL_SECONDS * 2)
+
+
+def watch_directory_loop(directory):
+    """
+    Sends the files already present once, then blocks on OS change notifications
+    and only looks at files reported as added (plus one catch-up rescan for files
+    created before the watcher was armed). Files that could not be read or sent
+    are retried on the next event or timeout until they are sent or deleted.
+    """
+    app.log("--- Waiting for file system events (watchfiles) ---")
+    try:
+        with os.scandir(directory) as entries:
+            initial_names = {entry.name for entry in entries if entry.is_file()}
+        retry_names = process_new_files(directory, initial_names)
+        if retry_names is None:
+            return
+        retry_names = set(retry_names)
+        # yield_on_timeout hands back an empty set every rust_timeout ms, which is
+        # where a vanished directory gets noticed
+        for changes in watch(directory, stop_event=monitor_stop_event, rust_timeout=5000, yield_on_timeout=True):
+            if not changes and not os.path.isdir(directory):
+                raise FileNotFoundError(directory)
+            added = [os.path.basename(path) for change, path in changes if change == Change.added]
+            retry_names.difference_update(os.path.basename(path) for change, path in changes
+                                          if change == Change.deleted)
+            if initial_names is not None:
+                # The watcher is only armed once watch() first runs, so files created while the
+                # initial listing was being sent produced no event. Rescan once now; the set
+                # merges names that were also reported as added.
+                added = set(added)
+                with os.scandir(directory) as entries:
+                    added.update(entry.name for entry in entries
+                                 if entry.name not in initial_names and entry.is_file())
+                initial_names = None
+            if added or retry_names:
+                unsent = process_new_files(directory, retry_names.union(added))
+                if unsent is None:
+                    return
+                retry_names = set(unsent)
+    except FileNotFoundError:
+        app.log(f"[FATAL] Monitored directory '{directory}' no longer exists. Stopping.")
+        app.stop_monitoring_logic()
+    except Exception as e:
+        app.log(f"[Error] File system watcher failed, falling back to polling: {e}")
+        poll_directory_loop(directory)
+
+
+def monitor_directory_loop(directory):
+    """
+    Monitors the target directory for new matching files and processes them
+    in the correct order, using OS file events when available.
+    """
+    app.log(f"--- Started monitoring folder: '{directory}' ---")
+    if watch is None or USE_POLLING:
+        poll_directory_loop(directory)
+    else:
+        watch_directory_loop(directory)
 
 
 # --- Socket.IO Event Handlers (Unchanged) ---
 @sio.event
-def connect():
+async def connect():
     app.update_status("Connected", "green")
     app.log(f"Successfully connected to server: {SERVER_URL}")
 
 @sio.event
-def connect_error(data):
+async def connect_error(data):
     app.update_status("Connection Failed", "red")
     app.log(f"Connection failed! Please check if the server is running at {SERVER_URL}.")
 
 @sio.event
-def disconnect():
+async def disconnect():
     app.update_status("Disconnected", "red")
     app.log("Disconnected from server.")
 
 @sio.on('set_filters')
-def on_set_filters(data):
-    global current_filters, processed_files, agent_thread, is_monitoring_active
+async def on_set_filters(data):
+    # Restarting the monitor joins its thread, which may itself be waiting on an
+    # emit; running it off the client loop keeps that emit able to finish
+    await asyncio.to_thread(apply_filters, data)
+
+
+def apply_filters(data):
+    global current_filters, processed_files, agent_thread, _filter_snapshot
     app.log(f"<-- Received new filter instructions from server: {data}")
-    current_filters.clear()
-    current_filters.update(data)
-    processed_files = set()
-    if agent_thread and agent_thread.is_alive():
-        is_monitoring_active = False
-        agent_thread.join()
-    is_monitoring_active = True
-    directory = app.watch_directory.get()
-    agent_thread = threading.Thread(target=monitor_directory_loop, args=(directory,), daemon=True)
-    agent_thread.start()
+    with filters_apply_lock:
+        # Stop the old monitor before touching the shared state, so it can neither match
+        # names against the new filters nor record its sends in the new session's set
+        if agent_thread and agent_thread.is_alive():
+            monitor_stop_event.set()
+            agent_thread.join()
+        current_filters.clear()
+        current_filters.update(data)
+        _filter_snapshot = build_filter_snapshot(current_filters)
+        processed_files = set()
+        monitor_stop_event.clear()
+        directory = app.watch_directory.get()
+        agent_thread = threading.Thread(target=monitor_directory_loop, args=(directory,), daemon=True)
+        agent_thread.start()
 
 
 # --- GUI Application Class ---
 class AgentApp:
+    __slots__ = ('root', 'watch_directory', 'folder_display', 'select_button', 'start_button', 'stop_button',
+                 'status_display', 'log_text', '_log_buffer', '_closing')
+
     def __init__(self, root):
         self.root = root
+        self._closing = False
         self.root.title("SACMES Lightweight Local Agent")
         self.root.geometry("600x450")
         self.root.minsize(500, 350)
@@ -170,6 +479,8 @@ class AgentApp:
         tk.Label(log_frame, text="Agent Log:").pack(anchor="w")
         self.log_text = scrolledtext.ScrolledText(log_frame, state='disabled', wrap=tk.WORD, font=("Courier New", 9))
         self.log_text.pack(fill=tk.BOTH, expand=True, pady=(5, 0))
+        self._log_buffer = deque(maxlen=5000)
+        self.root.after(LOG_FLUSH_INTERVAL_MS, self._flush_log)
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
     def select_folder(self):
@@ -200,8 +511,11 @@ class AgentApp:
             headers = {"Authorization": f"Bearer {AUTH_TOKEN}"}
 
             # --- THE ONLY CRITICAL CHANGE IS HERE ---
-            # We explicitly tell the client to ONLY use 'polling' and not attempt 'websocket'.
-            sio.connect(SERVER_URL, headers=headers, socketio_path='socket.io', transports=['polling'])
+            # The handshake always goes over 'polling'. Engine.IO then probes a 'websocket'
+            # upgrade and keeps the session on polling if a proxy blocks it, so files are
+            # sent as WebSocket frames instead of one HTTP request each wherever possible.
+            run_on_sio_loop(sio.connect(SERVER_URL, headers=headers, socketio_path='socket.io',
+                                        transports=SIO_TRANSPORTS))
 
             self.log("Agent is now running and waiting for analysis instructions from the server...")
         except socketio.exceptions.ConnectionError as e:
@@ -217,12 +531,13 @@ class AgentApp:
         self.log("Stopping process...")
         self.stop_monitoring_logic()
         if sio.connected:
-            sio.disconnect()
+            # Fire and forget: waiting here would block the Tk thread on the socket loop
+            asyncio.run_coroutine_threadsafe(sio.disconnect(), sio_loop)
 
     def stop_monitoring_logic(self):
-        global is_monitoring_active, agent_thread
-        is_monitoring_active = False
-        if agent_thread and agent_thread.is_alive():
+        monitor_stop_event.set()
+        # May be called from the monitor thread itself, which cannot join itself
+        if agent_thread and agent_thread.is_alive() and agent_thread is not threading.current_thread():
             agent_thread.join(timeout=POLLING_INTERVAL_SECONDS + 1)
         self.start_button.config(state=tk.NORMAL)
         self.stop_button.config(state=tk.DISABLED)
@@ -230,15 +545,30 @@ class AgentApp:
         self.log("Monitoring has been stopped.")
 
     def log(self, message):
-        self.root.after(0, self._log_message, message)
-
-    def _log_message(self, message):
-        self.log_text.config(state='normal')
-        self.log_text.insert(tk.END, f"{time.strftime('%H:%M:%S')} - {message}\n")
-        self.log_text.config(state='disabled')
-        self.log_text.see(tk.END)
+        # Called from any thread; deque appends are atomic and _flush_log drains them
+        self._log_buffer.append(message)
+
+    def _flush_log(self):
+        if self._log_buffer:
+            # One timestamp per flush; lines are at most LOG_FLUSH_INTERVAL_MS late
+            stamp = time.strftime('%H:%M:%S')
+            lines = []
+            while self._log_buffer:
+                lines.append(f"{stamp} - {self._log_buffer.popleft()}")
+            self.log_text.config(state='normal')
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            # 'end-1c' is on the empty line after the last newline, so this counts it too
+            excess = int(self.log_text.index('end-1c').split('.')[0]) - 1 - LOG_MAX_LINES
+            if excess > 0:
+                self.log_text.delete('1.0', f'{excess + 1}.0')
+            self.log_text.config(state='disabled')
+            self.log_text.see(tk.END)
+        self.root.after(LOG_FLUSH_INTERVAL_MS, self._flush_log)
 
     def update_status(self, text, color):
+        # Socket handlers still fire while the window is being torn down; leave Tk alone then
+        if self._closing:
+            return
         self.root.after(0, self._update_status, text, color)
 
     def _update_status(self, text, color):
@@ -246,7 +576,9 @@ class AgentApp:
 
     def on_closing(self):
         if messagebox.askokcancel("Quit", "Are you sure you want to close the agent?"):
+            self._closing = True
             self.stop_monitoring()
+            reader_pool.shutdown(wait=False, cancel_futures=True)
             self.root.destroy()
 
 
@@ -3,13 +3,16 @@
 import eventlet
 eventlet.monkey_patch()
 
+import hmac
+import io
 import os
 import re
 import logging
 import sys
+import zlib
+import numpy as np
 from flask import Flask, send_from_directory, request
 from flask_socketio import SocketIO, emit
-from werkzeug.utils import secure_filename
 
 # --- Logging Setup (Unchanged) ---
 log_handler = logging.StreamHandler(sys.stdout)
@@ -31,66 +34,74 @@ except ImportError as e:
 app = Flask(__name__, static_folder='static', static_url_path='')
 app.config['SECRET_KEY'] = 'a_very_secret_key_that_should_be_changed'
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', logger=True, engineio_logger=True)
-UPLOAD_FOLDER = 'temp_uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 AGENT_AUTH_TOKEN = os.environ.get('AGENT_AUTH_TOKEN', "your_super_secret_token_here")
+# Encoded once for the constant-time comparison in handle_connect
+AGENT_AUTH_TOKEN_BYTES = AGENT_AUTH_TOKEN.encode('utf-8')
+# SWV data file name: <handle>_<freq>Hz_<num>.<ext> (zero to two underscores before <num>)
+FILE_RE = re.compile(r'_(\d+)Hz_?_?(\d+)\.', re.IGNORECASE)
+FREQ_RE = re.compile(r'_(\d+)Hz', re.IGNORECASE)
 agent_sid, web_viewer_sids, live_analysis_params, live_trend_data = None, set(), {}, {}
+# Partially received chunked files: (sid, filename) -> [next expected seq, bytearray, encoding]
+chunked_uploads = {}
 
-# --- Helper function calculate_trends (Unchanged) ---
-def calculate_trends(raw_peaks, params):
+# --- Trend data helpers (MODIFIED) ---
+# A session's trends live in arrays with one row per frequency (ascending) and one
+# column per file; NaN marks a file that has no peak yet.
+def _to_json_list(values):
+    # Viewers expect None for missing values
+    return np.where(np.isnan(values), None, values).tolist()
+
+def new_trend_data(params):
+    freq_strs = list(dict.fromkeys(str(f) for f in sorted(params.get('frequencies', []))))
     num_files = params.get('num_files', 1)
-    frequencies = params.get('frequencies', [])
-    normalization_point = params.get('normalizationPoint', 1)
-    if not frequencies: return {}
-    frequencies.sort()
-    low_freq_str, high_freq_str = str(frequencies[0]), str(frequencies[-1])
-    x_axis_values = list(range(1, num_files + 1))
-    peak_current_trends = {str(f): [None] * num_files for f in frequencies}
-    normalized_peak_trends = {str(f): [None] * num_files for f in frequencies}
-    kdm_trend = [None] * num_files
-    for i, file_num in enumerate(x_axis_values):
-        for freq_str in peak_current_trends:
-            peak = raw_peaks.get(freq_str, {}).get(str(file_num))
-            if peak is not None: peak_current_trends[freq_str][i] = peak
-    norm_factors = {}
-    for freq_str in peak_current_trends:
-        norm_idx = normalization_point - 1
-        if 0 <= norm_idx < len(peak_current_trends[freq_str]):
-            norm_value = peak_current_trends[freq_str][norm_idx]
-            norm_factors[freq_str] = norm_value if norm_value and norm_value != 0 else 1.0
-        else: norm_factors[freq_str] = 1.0
-    for i in range(num_files):
-        for freq_str in peak_current_trends:
-            peak = peak_current_trends[freq_str][i]
-            if peak is not None and norm_factors.get(freq_str):
-                normalized_peak_trends[freq_str][i] = peak / norm_factors[freq_str]
-        low_peak = peak_current_trends.get(low_freq_str, [])[i]
-        high_peak = peak_current_trends.get(high_freq_str, [])[i]
-        if low_peak is not None and high_peak is not None and high_peak != 0:
-            kdm_trend[i] = low_peak / high_peak
-    return {"x_axis_values": x_axis_values, "peak_current_trends": peak_current_trends, "normalized_peak_trends": normalized_peak_trends, "kdm_trend": kdm_trend}
+    peaks = np.full((len(freq_strs), num_files), np.nan)
+    return {"freq_rows": {freq_str: row for row, freq_str in enumerate(freq_strs)}, "num_files": num_files,
+            "norm_idx": params.get('normalizationPoint', 1) - 1, "peaks": peaks, "normalized": peaks.copy(),
+            "norm_factors": np.ones(len(freq_strs)), "kdm": np.full(num_files, np.nan)}
+
+def record_peak(trend_data, freq_str, file_num, peak):
+    """Stores one file's peak and updates only the trend values that depend on it."""
+    row, col = trend_data['freq_rows'].get(freq_str), file_num - 1
+    if row is None or not 0 <= col < trend_data['num_files']: return
+    peaks, norm_factors = trend_data['peaks'], trend_data['norm_factors']
+    peaks[row, col] = np.nan if peak is None else peak
+    if col == trend_data['norm_idx']:
+        # A new normalization point rescales the whole row
+        norm_value = peaks[row, col]
+        norm_factors[row] = 1.0 if np.isnan(norm_value) or norm_value == 0 else norm_value
+        trend_data['normalized'][row] = peaks[row] / norm_factors[row]
+    else:
+        trend_data['normalized'][row, col] = peaks[row, col] / norm_factors[row]
+    if row == 0 or row == len(peaks) - 1:
+        high_peak = peaks[-1, col]
+        trend_data['kdm'][col] = peaks[0, col] / high_peak if high_peak != 0 else np.nan
+
+def trends_to_json(trend_data):
+    if not trend_data['freq_rows']: return {}
+    rows = trend_data['freq_rows'].items()
+    return {"x_axis_values": list(range(1, trend_data['num_files'] + 1)),
+            "peak_current_trends": {freq_str: _to_json_list(trend_data['peaks'][row]) for freq_str, row in rows},
+            "normalized_peak_trends": {freq_str: _to_json_list(trend_data['normalized'][row]) for freq_str, row in rows},
+            "kdm_trend": _to_json_list(trend_data['kdm'])}
 
 # --- Background Task (MODIFIED) ---
 def process_file_in_background(original_filename, content, params_for_this_file):
     logger.info(f"BACKGROUND_TASK: Started processing for '{original_filename}'.")
-    filename = secure_filename(original_filename)
-    temp_filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     try:
-        with open(temp_filepath, 'w', encoding='utf-8') as f: f.write(content)
         if not analyze_swv_data:
             logger.error("BACKGROUND_TASK: swv_analyzer is not available. Aborting analysis.")
             return
-        analysis_result = analyze_swv_data(temp_filepath, params_for_this_file)
+        # The payload is analyzed from memory; binary payloads from the agent are decoded by ReadData
+        data_file = io.BytesIO(content) if isinstance(content, (bytes, bytearray)) else io.StringIO(content)
+        analysis_result = analyze_swv_data(data_file, params_for_this_file)
         logger.info(f"BACKGROUND_TASK: Analysis for '{original_filename}' completed with status: {analysis_result.get('status')}.")
         if analysis_result and analysis_result.get('status') in ['success', 'warning']:
-            match = re.search(r'_(\d+)Hz_?_?(\d+)\.', original_filename, re.IGNORECASE)
+            match = FILE_RE.search(original_filename)
             if match:
                 parsed_frequency, parsed_filenum = int(match.group(1)), int(match.group(2))
                 peak = analysis_result.get('peak_value')
-                live_trend_data['raw_peaks'][str(parsed_frequency)][str(parsed_filenum)] = peak
-        full_trends = calculate_trends(live_trend_data['raw_peaks'], live_analysis_params)
+                record_peak(live_trend_data, str(parsed_frequency), parsed_filenum, peak)
+        full_trends = trends_to_json(live_trend_data)
         logger.info(f"BACKGROUND_TASK: Trend calculation complete. Emitting update.")
         if web_viewer_sids:
             # --- KEY FIX IS HERE: Removed the invalid 'broadcast=True' argument ---
@@ -98,7 +109,6 @@ def process_file_in_background(original_filename, content, params_for_this_file)
     except Exception as e:
         logger.error(f"BACKGROUND_TASK: CRITICAL ERROR while processing '{original_filename}': {e}", exc_info=True)
     finally:
-        if os.path.exists(temp_filepath): os.remove(temp_filepath)
         logger.info(f"BACKGROUND_TASK: Finished job for '{original_filename}'.")
 
 # --- Socket.IO Event Handlers (MODIFIED) ---
@@ -107,8 +117,9 @@ def handle_connect():
     global agent_sid
     logger.info(f"Client connected with SID: {request.sid}")
     auth_header = request.headers.get('Authorization')
-    token = auth_header.split(' ')[1] if auth_header and auth_header.startswith('Bearer ') else None
-    if token and token == AGENT_AUTH_TOKEN:
+    token = auth_header[7:] if auth_header and auth_header[:7] == 'Bearer ' else ''
+    # compare_digest takes the same time wherever the first mismatch is, so the token can't be guessed byte by byte
+    if token and hmac.compare_digest(token.encode('utf-8'), AGENT_AUTH_TOKEN_BYTES):
         agent_sid = request.sid
         logger.info(f"Authenticated client is an AGENT. SID: {agent_sid}")
         # --- FIX: Removed 'broadcast=True' when 'to' is specified ---
@@ -124,6 +135,8 @@ def handle_disconnect():
     if request.sid == agent_sid:
         agent_sid = None
         logger.warning("Agent has disconnected.")
+        for key in [key for key in chunked_uploads if key[0] == request.sid]:
+            del chunked_uploads[key]
         # --- FIX: Removed 'broadcast=True' when 'to' is specified ---
         emit('agent_status', {'status': 'disconnected'}, to=list(web_viewer_sids))
     elif request.sid in web_viewer_sids:
@@ -137,7 +150,7 @@ def handle_start_analysis_session(data):
     logger.info(f"Received 'start_analysis_session' from {request.sid}")
     if 'analysisParams' in data:
         live_analysis_params = data['analysisParams']
-        live_trend_data = {"raw_peaks": {str(f): {} for f in live_analysis_params.get('frequencies', [])}}
+        live_trend_data = new_trend_data(live_analysis_params)
         logger.info("Analysis session started. Params set and trend data reset.")
     if 'filters' in data and agent_sid:
         filters = data['filters']
@@ -154,11 +167,50 @@ def handle_instrument_data(data):
     if request.sid != agent_sid: return
     original_filename = data.get('filename', 'unknown_file.txt')
     logger.info(f"Received 'stream_instrument_data' for file '{original_filename}' from agent.")
+    queue_instrument_file(original_filename, item_content(data))
+
+@socketio.on('stream_instrument_data_batch')
+def handle_instrument_data_batch(data):
+    if request.sid != agent_sid: return
+    items = data.get('items', [])
+    logger.info(f"Received 'stream_instrument_data_batch' with {len(items)} file(s) from agent.")
+    for item in items:
+        queue_instrument_file(item.get('filename', 'unknown_file.txt'), item_content(item))
+
+@socketio.on('stream_instrument_chunk')
+def handle_instrument_chunk(data):
+    if request.sid != agent_sid: return
+    original_filename = data.get('filename', 'unknown_file.txt')
+    key = (request.sid, original_filename)
+    seq = data.get('seq', 0)
+    if seq == 0:
+        chunked_uploads[key] = [0, bytearray(), data.get('encoding')]
+    upload = chunked_uploads.get(key)
+    if upload is None or upload[0] != seq:
+        logger.warning(f"Dropping out-of-order chunk {seq} for '{original_filename}'.")
+        chunked_uploads.pop(key, None)
+        return
+    upload[0] += 1
+    upload[1] += data.get('data', b'')
+    if data.get('final'):
+        del chunked_uploads[key]
+        logger.info(f"Received chunked 'stream_instrument_data' for file '{original_filename}' ({upload[0]} chunks) from agent.")
+        # The reassembly buffer is handed on as is; copying it into bytes would double the peak
+        content = zlib.decompress(upload[1]) if upload[2] == 'deflate' else upload[1]
+        queue_instrument_file(original_filename, content)
+
+def item_content(item):
+    # Agents may deflate file bodies before sending them ('encoding': 'deflate')
+    if item.get('encoding') == 'deflate':
+        return zlib.decompress(item.get('content_z', b''))
+    return item.get('content', '')
+
+def queue_instrument_file(original_filename, content):
     if not live_analysis_params:
         logger.warning("Received instrument data, but analysis params are not set. Ignoring.")
         return
     params_for_this_file = live_analysis_params.copy()
-    match = re.search(r'_(\d+)Hz', original_filename, re.IGNORECASE)
+    match = FREQ_RE.search(original_filename)
     if match:
         params_for_this_file['frequency'] = int(match.group(1))
     else:
@@ -168,7 +220,7 @@ def handle_instrument_data(data):
     params_for_this_file.setdefault('low_xend', None)
     params_for_this_file.setdefault('high_xstart', None)
     params_for_this_file.setdefault('high_xend', None)
-    socketio.start_background_task(target=process_file_in_background, original_filename=original_filename, content=data.get('content', ''), params_for_this_file=params_for_this_file)
+    socketio.start_background_task(target=process_file_in_background, original_filename=original_filename, content=content, params_for_this_file=params_for_this_file)
     logger.info(f"Queued background processing for '{original_filename}'. Handler is now free.")
 
 @app.route('/')
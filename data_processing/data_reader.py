@@ -1,20 +1,35 @@
+import io
 import numpy as np
 
 def ReadData(myfile, voltage_column_index, current_column_start_index, spacing_index, num_electrodes, delimiter_char, file_extension=".txt"):
-    """Enhanced ReadData to support Gamry .DTA files by skipping header lines."""
+    """
+    Enhanced ReadData to support Gamry .DTA files by skipping header lines.
+    myfile is a path or an open file object (text or binary).
+    """
     potentials = []
     currents_raw_per_electrode = [[] for _ in range(num_electrodes)]
     data_dict = {}
     encoding = "utf-8"
 
     # --- Detect encoding ---
-    try:
-        with open(myfile, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-    except UnicodeDecodeError:
-        encoding = "utf-16"
-        with open(myfile, "r", encoding=encoding) as f:
-            lines = f.readlines()
+    if hasattr(myfile, "read"):
+        data = myfile.read()
+        if isinstance(data, (bytes, bytearray)):
+            # UTF-16 only when the bytes say so (BOM or NUL bytes); anything else is read as
+            # UTF-8, dropping stray bytes such as cp1252 µ/° instead of misreading the file
+            if data[:2] in (b"\xff\xfe", b"\xfe\xff") or b"\x00" in data:
+                encoding = "utf-16"
+            data = data.decode(encoding, errors="ignore")
+        # newline=None gives the same universal-newline handling as reading a file in text mode
+        lines = io.StringIO(data, newline=None).readlines()
+    else:
+        try:
+            with open(myfile, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except UnicodeDecodeError:
+            encoding = "utf-16"
+            with open(myfile, "r", encoding=encoding) as f:
+                lines = f.readlines()
 
     # --- Handle Gamry .DTA files ---
     if file_extension.lower() == ".dta": # Explicitly check for .dta extension
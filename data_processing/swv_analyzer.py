@@ -15,6 +15,7 @@ logger = logging.getLogger(__name__)
 def analyze_swv_data(file_path, analysis_params):
     """
     Analyzes a single SWV data file based on provided parameters.
+    file_path may also be an open file object, e.g. an in-memory buffer.
     Implements a robust tangent-based baseline correction using a convex hull approach.
     """
     delimiter_map = {1: " ", 2: "\t", 3: ","}